@@ -25,6 +25,9 @@ setup(
         'questionary',
         'tqdm'
     ],
+    extras_require={
+        'fast': ['fitsio', 'numba', 'xxhash']
+    },
     entry_points = {
         "console_scripts": [
             "ori=ori:main"
@@ -7,5 +7,8 @@ def main():
         target_dir=args.target_dir,
         days_old = args.days_old,
         reset_cache=args.reset,
-        allow_siril=args.allow_siril
+        allow_siril=args.allow_siril,
+        jobs=args.jobs,
+        skip_parsing=args.skip_parsing,
+        io_depth=args.io_depth
     )
\ No newline at end of file
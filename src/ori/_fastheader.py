@@ -0,0 +1,201 @@
+"""
+Minimal reader for the primary HDU header of a FITS file.
+
+FITS headers are a sequence of fixed-width 80-byte cards packed into 2880-byte blocks
+and terminated by an END card. Rather than building astropy Header/Card objects, the
+file is memory-mapped and cards are sliced directly out of it, so only the blocks up
+to the END card are ever paged in. When Numba is installed the cards are tokenized by a
+compiled loop over the raw bytes, leaving only the decoding of values to Python.
+"""
+from __future__ import annotations
+import mmap
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+CARD_SIZE = 80
+BLOCK_SIZE = 2880
+
+
+def _parse_string(field: bytes) -> str:
+    # Quotes inside FITS strings are escaped by doubling them ('')
+    end = 1
+    while True:
+        end = field.find(b"'", end)
+        if end == -1:
+            raise ValueError(f"Unterminated string value: {field!r}")
+        if field[end + 1:end + 2] != b"'":
+            break
+        end += 2
+    return field[1:end].replace(b"''", b"'").rstrip().decode('ascii', 'replace')
+
+
+def _parse_value(field: bytes) -> str:
+    """
+    Converts the value field of a card (everything after '= ') to the same string
+    that str() gives for the corresponding astropy header value.
+    """
+    field = field.strip()
+    if field.startswith(b"'"):
+        return _parse_string(field)
+    value = field.split(b'/', 1)[0].strip()
+    if value == b'':
+        # astropy reads a card with no value as Undefined, which it gives back as None
+        return 'None'
+    if value == b'T':
+        return 'True'
+    if value == b'F':
+        return 'False'
+    try:
+        return str(int(value))
+    except ValueError:
+        pass
+    try:
+        return str(float(value.replace(b'D', b'E')))
+    except ValueError:
+        pass
+    if value.startswith(b'(') and value.endswith(b')'):
+        real, sep, imag = value[1:-1].partition(b',')
+        try:
+            return str(complex(float(real.replace(b'D', b'E')), float(imag.replace(b'D', b'E'))))
+        except ValueError:
+            pass
+    return value.decode('ascii', 'replace')
+
+
+def _parse_card(header: dict, key: str | None, card: bytes) -> str | None:
+    """
+    Adds a single value card to `header`, returning its keyword (or None for commentary
+    cards) so that a following CONTINUE card can be appended to it.
+    """
+    name = card[:8].rstrip()
+    if name == b'CONTINUE' and key is not None and header[key].endswith('&'):
+        header[key] = header[key][:-1] + _parse_string(card[8:].strip())
+        return key
+    if name == b'HIERARCH':
+        name, sep, field = card[9:].partition(b'=')
+        if not sep:
+            return None
+        name = name.strip()
+    elif card[8:10] == b'= ':
+        field = card[10:]
+    else:
+        # Commentary cards (COMMENT, HISTORY, blank keywords) carry no value
+        return None
+    key = name.decode('ascii')
+    header[key] = _parse_value(field)
+    return key
+
+
+def _parse_cards(buf) -> dict[str, str]:
+    header = dict()
+    key = None
+    for i in range(0, len(buf) - CARD_SIZE + 1, CARD_SIZE):
+        card = buf[i:i + CARD_SIZE]
+        if card[:8].rstrip() == b'END':
+            return header
+        key = _parse_card(header, key, card)
+    raise ValueError("No END card found in header")
+
+
+def _scan_cards(buf: np.ndarray) -> tuple[int, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Tokenizes the cards in `buf` (a uint8 view of the file) up to the END card. Returns the
+    number of cards before END (-1 if there isn't one) and, for each card, the length of its
+    keyword and the start/end offsets of its value with any trailing comment removed. Cards
+    that need more than that (commentary, CONTINUE, HIERARCH) get a start offset of -1.
+    Compiled with Numba when it's installed.
+    """
+    ncards = -1
+    for i in range(len(buf) // CARD_SIZE):
+        base = i * CARD_SIZE
+        if buf[base] == 69 and buf[base + 1] == 78 and buf[base + 2] == 68:  # END
+            is_end = True
+            for j in range(base + 3, base + 8):
+                if buf[j] != 32:
+                    is_end = False
+            if is_end:
+                ncards = i
+                break
+    if ncards < 0:
+        return ncards, np.empty(0, np.int32), np.empty(0, np.int32), np.empty(0, np.int32)
+
+    key_len = np.empty(ncards, np.int32)
+    val_start = np.full(ncards, -1, np.int32)
+    val_end = np.full(ncards, -1, np.int32)
+    for i in range(ncards):
+        base = i * CARD_SIZE
+        k = 8
+        while k > 0 and buf[base + k - 1] == 32:
+            k -= 1
+        key_len[i] = k
+        if buf[base + 8] != 61 or buf[base + 9] != 32:  # '= '
+            continue
+        # The value ends at the first '/' outside of a quoted string. Doubled quotes
+        # ('') toggle in and out of the string, so they don't need special handling
+        j = base + 10
+        in_string = False
+        while j < base + CARD_SIZE:
+            if buf[j] == 39:  # '
+                in_string = not in_string
+            elif buf[j] == 47 and not in_string:  # /
+                break
+            j += 1
+        val_start[i] = base + 10
+        val_end[i] = j
+    return ncards, key_len, val_start, val_end
+
+
+def _parse_scanned(buf) -> dict[str, str]:
+    ncards, key_len, val_start, val_end = _scan_cards(np.frombuffer(buf, dtype=np.uint8))
+    if ncards < 0:
+        raise ValueError("No END card found in header")
+    header = dict()
+    key = None
+    for i in range(ncards):
+        start = val_start[i]
+        if start < 0:
+            key = _parse_card(header, key, buf[i * CARD_SIZE:(i + 1) * CARD_SIZE])
+        else:
+            key = buf[i * CARD_SIZE:i * CARD_SIZE + key_len[i]].decode('ascii')
+            header[key] = _parse_value(buf[start:val_end[i]])
+    return header
+
+
+if numba is not None:
+    _scan_cards = numba.njit(cache=True)(_scan_cards)
+    _parse = _parse_scanned
+else:
+    # Walking the cards in an interpreted loop over a numpy array would be slower than
+    # slicing bytes, so without Numba the cards are parsed directly
+    _parse = _parse_cards
+
+
+def header_from_bytes(buf, path = None) -> dict[str, str]:
+    """
+    Returns the keyword/value pairs from a header held in `buf`, e.g. the first few
+    blocks of a FITS file. Raises OSError if `buf` doesn't start a FITS file, and
+    ValueError if it couldn't be parsed (including when it stops short of the END card).
+    """
+    if buf[:8] != b'SIMPLE  ':
+        raise OSError(f"Empty or corrupt FITS file: {path}")
+    return _parse(buf)
+
+
+def fast_header(path) -> dict[str, str]:
+    """
+    Returns the keyword/value pairs from the primary header of the FITS file at `path`.
+    Commentary cards are skipped. Raises OSError if the file is not a FITS file, and
+    ValueError if the header could not be parsed.
+    """
+    with open(path, 'rb') as fh:
+        try:
+            buf = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise OSError(f"Empty or corrupt FITS file: {path}")
+        with buf:
+            return header_from_bytes(buf, path)
@@ -1,45 +1,169 @@
 from __future__ import annotations
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import chain, repeat
+import functools
 import textwrap
-import subprocess
 import logging
+import time
+import os
+import platform
 import argparse
 
 from tqdm import tqdm
+import numpy as np
 import pandas as pd
 import questionary as q
 from astropy.io import fits
 
-from .cache import Cache
-from .index import Index
-
-def is_valid(f: Path, allow_siril: bool):
-    if allow_siril:
-        return not (f.is_symlink())
-    else:
-        return not (f.is_symlink() or f.name.startswith('r_') or f.name.startswith('pp_'))
-
-def find_fits(target_dir: Path, pattern = "*.fit*", days = None, allow_siril = False):
-    if days is not None:
-        cmd = subprocess.run(
-            ['find', str(target_dir), '-mtime', f'-{days}', '-name', pattern], 
-            stdout=subprocess.PIPE, text=True
-        )
-        return [str(f) for f in cmd.stdout.splitlines() if is_valid(Path(str(f)), allow_siril)]
-    else:
-        return [str(f) for f in tqdm(target_dir.rglob(pattern), unit = ' files') if is_valid(f, allow_siril)]    
+try:
+    import fitsio
+except ImportError:
+    fitsio = None
 
-
-def parse_fits_headers(files):
-    rows, skipped = list(), list()
-    for f in tqdm(files, unit = " files", desc="Parsing headers"):
+from ._fastheader import BLOCK_SIZE, fast_header, header_from_bytes
+from .cache import Cache
+from .index import Index, value_counts
+from .utils import _walk_fits
+
+"""
+Returns the paths of FITS files under `target_dir`. On Linux the paths are returned in
+inode order (read for free from the directory entries), which roughly follows on-disk
+layout and cuts seeks when the headers are read from a spinning disk.
+"""
+def find_fits(target_dir: Path, days = None, allow_siril = False) -> list[str]:
+    since = time.time() - days * 86400 if days is not None else None
+    entries = tqdm(_walk_fits(str(target_dir), allow_siril, since), unit = ' files')
+    if platform.system() == 'Linux':
+        entries = sorted(entries, key = lambda e: e.inode())
+    return [e.path for e in entries]
+
+
+# Most headers fit in the first few blocks, which can be fetched in a single read
+HEADER_READ_SIZE = 4 * BLOCK_SIZE
+
+def read_header(f, start: bytes = None):
+    """
+    Returns the (key, value) cards of the primary HDU header of `f`. Headers are read
+    with the minimal card scanner in _fastheader, from `start` (the beginning of the 
+    file) when it's been read already and holds the whole header. Falls back to CFITSIO
+    via fitsio (when installed) or astropy for headers the scanner can't handle.
+    """
+    try:
+        if start is not None:
+            try:
+                return header_from_bytes(start, f).items()
+            except ValueError:
+                pass
+        return fast_header(f).items()
+    except ValueError:
+        pass
+    if fitsio is not None:
+        with fitsio.FITS(f) as hdus:
+            return [(r['name'], r['value']) for r in hdus[0].read_header().records()]
+    return list(fits.getheader(f).items())
+
+def _read_start(f):
+    try:
+        with open(f, 'rb') as fh:
+            return fh.read(HEADER_READ_SIZE)
+    except OSError:
+        # Let read_header raise the error
+        return None
+
+"""
+Returns a file's header as parallel key and value columns, which are much cheaper to
+send back from a worker process than one (file, key, value) tuple per card.
+"""
+def _parse_one(f, start = None):
+    try:
+        cards = read_header(f, start)
+    except OSError as e:
+        return f, None, None, e
+    return f, [str(k) for k, _ in cards], [str(v) for _, v in cards], None
+
+"""
+Passes through `files`, asking the kernel to start reading the first header block of
+the file `depth` places ahead so it's (hopefully) in the page cache by the time it's parsed.
+"""
+def _readahead(files, depth = 16):
+    def willneed(f):
         try:
-            header = fits.getheader(f)
-            for k, v in header.items():
-                rows.append((str(f), str(k), str(v)))
-        except OSError as e:
-            skipped.append(f)
-    return rows, skipped
+            fd = os.open(f, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.posix_fadvise(fd, 0, BLOCK_SIZE, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+
+    for f in files[:depth]:
+        willneed(f)
+    for i, f in enumerate(files):
+        if i + depth < len(files):
+            willneed(files[i + depth])
+        yield f
+
+"""
+Parses a batch of files, keeping up to `depth` reads of their first blocks in flight at 
+once. Reading one file at a time leaves SSDs (and RAID/network storage) mostly idle, 
+while many outstanding requests let the device and kernel service them in parallel.
+"""
+def _parse_batch(files, depth = 32):
+    with ThreadPoolExecutor(max_workers = depth) as ex:
+        return [_parse_one(f, start) for f, start in zip(files, ex.map(_read_start, files))]
+
+"""
+Reads the headers of `files` in a pool of `max_workers` processes (defaults to the
+number of CPUs) and streams them straight into `cache`, so the parsed rows are never
+all held in memory. Each process keeps up to `depth` reads in flight (defaults to 1 
+when `max_workers` is 1, and 32 otherwise). On spinning disks random seeks dominate, so
+a single worker reading one file at a time, in the order given, is usually best.
+The (file, mtime, size) `manifest` of the files is stored with them. Returns the files 
+whose headers could not be read.
+"""
+def parse_fits_headers(files, cache: Cache, max_workers = None, manifest = (), depth = None):
+    skipped = list()
+    if depth is None:
+        depth = 1 if max_workers == 1 else 32
+
+    def rows():
+        with ProcessPoolExecutor(max_workers = max_workers) as ex:
+            # The pool only starts processes on first use, so a single worker runs in-process
+            if max_workers == 1 and depth == 1:
+                # Sequential reads keep to the (inode) order of `files`; the kernel is told
+                # about upcoming files so their first blocks can be queued in the meantime
+                results = map(_parse_one, _readahead(files) if hasattr(os, 'posix_fadvise') else files)
+            else:
+                batches = [files[i:i + 64] for i in range(0, len(files), 64)]
+                parse_batch = functools.partial(_parse_batch, depth = depth)
+                if max_workers == 1:
+                    results = chain.from_iterable(map(parse_batch, batches))
+                else:
+                    results = chain.from_iterable(ex.map(parse_batch, batches))
+            for f, keys, values, err in tqdm(results, total = len(files), unit = " files", desc="Parsing headers"):
+                if err: 
+                    skipped.append(f)
+                else:
+                    yield from zip(repeat(f), keys, values)
+
+    # Drop anything previously cached for these files so that removed keys don't linger
+    cache.invalidate(files)
+    # skipped is filled in as the rows are consumed, before insert_iter reads it
+    cache.insert_iter(rows(), skipped, manifest)
+    return skipped
+
+"""
+Returns the (file, mtime, size) of each of `files`, which is compared against the cache's
+manifest to find new or modified files. Files that have disappeared since the scan are dropped.
+"""
+def _manifest(files):
+    for f in files:
+        try:
+            st = os.stat(f)
+        except OSError:
+            continue
+        yield f, st.st_mtime, st.st_size
 
 def prompt_destination(default, msg = 'Destination'):
     dest = q.path(msg, default=default, only_directories=True).ask()
@@ -79,7 +203,7 @@ class App(Index):
     or clear selected values and start over. 
     """
     def iselect_values(self):
-        if not all(self.rowmask):
+        if not self.rowmask.all():
 
             option = q.select(
                 "What would you like to do with existing selection?", 
@@ -90,7 +214,7 @@ class App(Index):
             if option == 'Discard':
                 self.reset_rowmask()
             elif option == 'Invert':
-                self.rowmask = [not _ for _ in self.rowmask]
+                self.rowmask = ~self.rowmask
             elif option is None:
                 return
         
@@ -116,10 +240,9 @@ class App(Index):
             while len(selected_values) == 0:
                 print("Error: at least one option needs to be selected with [space]")
                 selected_values = prompt.ask()
-            value_mask = [value in selected_values for value in self.selection[attr]]
-            if self._missing_label in selected_values:
-                value_mask = value_mask | self.selection[attr].isna()
-            self.selection = self.selection[value_mask]
+            groups = self._groups(attr)
+            rows = np.concatenate([groups[value] for value in selected_values])
+            self.selection = self.selection.iloc[rows]
         return self        
 
 
@@ -153,7 +276,7 @@ class App(Index):
             if len(problem_df) > 0:
                 with pd.option_context('display.max_rows', None):
                     print(f"{imgtype.upper()} FRAMES: ")
-                    print(problem_df.value_counts().to_frame("Files"))
+                    print(value_counts(problem_df).to_frame("Files"))
                     problem_files = problem_files + problem_df.index.tolist()
                     attr_list = attr_list + attrs
         if len(problem_files) > 0:
@@ -172,7 +295,7 @@ class App(Index):
         calib_type = q.select("Calibration type:", choices = calib_data.keys()).ask()
         calib_frames = self.calibration_frames(calib_type)
         c_attrs = calib_data[calib_type]['attrs']
-        print(calib_frames.value_counts(subset = c_attrs + ['_STATUS']))
+        print(value_counts(calib_frames, subset = c_attrs + ['_STATUS']))
         available = calib_frames.query("_STATUS == 'Available'")
         def _add(): 
             self.stash_rowmask()
@@ -212,7 +335,7 @@ class App(Index):
                 "Match CCD-TEMP to this many digits [1 = 0.1, 0 = 1, -1 = 10, etc]:", 
                 default="0", validate=int_validator).ask()
         calib_frames = self.calibration_frames2(calib_type, int(exp_tolerance), int(temp_tolerance))
-        counts = calib_frames.value_counts(subset = c_attrs + ['_STATUS']).to_frame("files").reset_index()
+        counts = value_counts(calib_frames, subset = c_attrs + ['_STATUS']).to_frame("files").reset_index()
         counts.loc[counts._STATUS == "Missing", ['files']] = pd.NA
         with pd.option_context('display.max_rows', None):
             print(counts.set_index(c_attrs + ['_STATUS']).fillna('~'))
@@ -274,7 +397,7 @@ class App(Index):
     
 
     def ichange_folders(self):
-        if not all(pd.isna(self.df._newpath)):
+        if self.has_renames('_newpath'):
             print("Error: previous file move/copy requested but not synced. Save changes and try again.")
             return
         destination = prompt_destination(
@@ -288,7 +411,7 @@ class App(Index):
 
 
     def iorganize(self):
-        if not all(pd.isna(self.df._newpath)):
+        if self.has_renames('_newpath'):
             print("Error: previous file move/copy requested but not synced. Save changes and try again.")
             return
         _root = prompt_destination(default = str(Path(self._root_dir).parent), msg = "New top-level directory:")
@@ -300,7 +423,7 @@ class App(Index):
             
 
     def iorganize_siril(self):
-        if not all(pd.isna(self.df._newpath)):
+        if self.has_renames('_newpath'):
             print("Error: previous file move/copy requested but not synced. Save changes and try again.")
             return
         print("Warning: the directory structure for Siril assumes you've already standardized the binning, gain, offset and ccd-temp for your selection. These attributes will not be reflected in the directory structure or file names.")
@@ -317,15 +440,15 @@ class App(Index):
             self.fill_missing_sessions()
 
     def iuse_prev_rowmask(self):
-        n_prev = sum(self._prev_rowmasks[-1])
+        n_prev = self._prev_rowmasks[-1].sum()
         if q.confirm(f"Use prior selection of {n_prev} files? Current selection will be lost.").ask():
-            self._rowmask = self._prev_rowmasks.pop()
+            self.rowmask = self._prev_rowmasks.pop()
             
 
 
     def isave_changes(self):
 
-        if any(~pd.isna(self.df._newpath)) or any(~pd.isna(self.df._newname)):
+        if self.has_renames():
             overwrite = False
             save_oldname = False
             op = q.select("Paths have changed. How do you want to save these changes?", choices = [
@@ -335,7 +458,7 @@ class App(Index):
             ]).ask()
             if op in ['move', 'copy']:
                 overwrite = q.confirm("Overwrite existing files, if they exist?", default=False).ask()
-                if any(~pd.isna(self.df._newname)):
+                if self.has_renames('_newname'):
                     save_oldname = q.confirm("Save record of old filenames as a HISTORY entry?", default=False).ask()
             elif op is None:
                 print("Save canceled")
@@ -361,7 +484,7 @@ class App(Index):
 
         while True:
             n_selected = len(self.selection)
-            n_changed = len(self.changed())
+            n_changed = self.n_changed()
             has_prev_rowmask = len(self._prev_rowmasks) > 0
 
             task_choices = [
@@ -390,7 +513,7 @@ class App(Index):
             else:
                 message = f"{n_selected} files selected.\nNext task:"
             if n_selected == 0:
-                self.rowmask = [True for _ in self.df.index]
+                self.reset_rowmask()
                 self.iselect_values()
             else:
                 task_select = [{
@@ -432,6 +555,18 @@ def parse_cli_args():
         action = "store_true"
     )
 
+    parser.add_argument(
+        "-j", "--jobs", metavar="N",
+        help = "Number of processes used to read headers (default: all CPUs). Use 1 for spinning disks, which reads files one at a time in on-disk order",
+        type = int
+    )
+
+    parser.add_argument(
+        "--io_depth", metavar="N",
+        help = "Number of header reads each process keeps in flight (default: 1 with -j 1, otherwise 32). Higher values help SSDs and network storage",
+        type = int
+    )
+
     parser.add_argument(
         "--skip_parsing", "-s",
         help = "Don't re-scan directory, just use the db",
@@ -441,26 +576,25 @@ def parse_cli_args():
     return parser.parse_args()
 
 
-def run_app(target_dir: str, days_old: int, reset_cache: bool, allow_siril: bool):
+def run_app(target_dir: str, days_old: int, reset_cache: bool, allow_siril: bool, jobs: int = None, skip_parsing: bool = False, io_depth: int = None):
 
     target_dir = Path(target_dir).resolve()
     cache = Cache(target_dir, reset = reset_cache)
-    print("Scanning for FITS files...")
-    files = find_fits(target_dir, days = days_old, allow_siril = allow_siril)
-
-    _headers, _skipped = cache.get()
-
-    cached_files = set([f for f, _, _ in _headers] + [f for f, in _skipped])
-    files_not_in_cache = [f for f in files if f not in cached_files]
-    if len(files_not_in_cache) == 0:
-        print("Cache hit")
-        headers = [h for h in _headers if h[0] in files]
+    if skip_parsing:
+        # Use whatever is already in the cache, without touching the filesystem
+        files = cache.cached_paths().tolist()
     else:
-        print("Cache miss")
-        headers, skipped = parse_fits_headers(files)
-        
-        print("Caching headers")
-        cache.set(headers, skipped)
+        print("Scanning for FITS files...")
+        files = find_fits(target_dir, days = days_old, allow_siril = allow_siril)
+
+        # Only files that are new or have been modified since they were cached need to be read
+        stale = cache.stale(_manifest(files))
+        if len(stale) == 0:
+            print("Cache hit")
+        else:
+            print("Cache miss")
+            parse_fits_headers([f for f, _, _ in stale], cache, max_workers = jobs, manifest = stale, depth = io_depth)
+    headers, _ = cache.get_for(files)
 
     if len(headers) == 0:
         logging.error("No valid FITS files found")
@@ -468,7 +602,7 @@ def run_app(target_dir: str, days_old: int, reset_cache: bool, allow_siril: bool
 
     fidx = App(headers, target_dir)
     fidx.iselect_attrs().iselect_values()
-    if any(fidx.df._CHANGED):
+    if fidx.n_changed() > 0:
         print("Default values for some attributes (e.g., SESSION) have been autofilled.")
     fidx.loop()
 
@@ -1,23 +1,43 @@
 from pathlib import Path
 import sqlite3
 
+import numpy as np
+import pandas as pd
+
 class Cache(object):
 
+    # Bump whenever the table layout changes; caches written with an older layout are rebuilt
+    _schema_version = 2
+
     def _mktables(con, reset=False):
         with con:
-            if reset:
+            version, = con.execute("pragma user_version").fetchone()
+            if reset or version != Cache._schema_version:
                 con.execute("drop table if exists headers")
                 con.execute("drop table if exists skipped")
-            con.execute(f"create table if not exists headers(file varchar, key varchar, value varchar)")
-            con.execute(f"create table if not exists skipped(file varchar)")
+                con.execute("drop table if exists manifest")
+                con.execute(f"pragma user_version = {Cache._schema_version}")
+            con.execute(
+                "create table if not exists headers(file varchar, key varchar, value varchar, primary key(file, key)) without rowid"
+            )
+            con.execute("create table if not exists skipped(file varchar primary key) without rowid")
+            con.execute("create table if not exists manifest(file varchar primary key, mtime real, size integer) without rowid")
 
     def __init__(self, target_dir:str, cache_name:str = ".fitz_cache", reset:bool = False):
         self._cache_file = Path(target_dir, cache_name)
-        con = sqlite3.connect(self._cache_file)
-        Cache._mktables(con, reset)
+        con = self._connect()
+        try:
+            Cache._mktables(con, reset)
+        finally:
+            con.close()
 
     def _connect(self):
-        return sqlite3.connect(self._cache_file)
+        con = sqlite3.connect(self._cache_file)
+        con.execute("pragma journal_mode = wal")
+        con.execute("pragma synchronous = normal")
+        con.execute("pragma temp_store = memory")
+        con.execute("pragma mmap_size = 268435456")
+        return con
 
     def exists(self):
         self._cache_file.exists()
@@ -36,13 +56,87 @@ class Cache(object):
             con.close()
         return headers, skipped
 
+    """
+    Returns the cached headers for just the given `files` as a file/attr/value DataFrame,
+    along with the list of skipped files. The requested paths are loaded into a temp table
+    and joined against the cache (keyed on file), so only matching rows ever leave SQLite. The
+    heavily repeated file and attr columns are dictionary-encoded as categoricals.
+    """
+    def get_for(self, files):
+        con = self._connect()
+        try:
+            with con:
+                con.execute("create temp table requested(file varchar primary key)")
+                con.executemany("insert or ignore into requested(file) values (?)", ((f,) for f in files))
+                headers = pd.read_sql_query(
+                    "select h.file, h.key as attr, h.value from headers h join requested r on h.file = r.file", 
+                    con, dtype = {'file': 'category', 'attr': 'category', 'value': 'object'}
+                )
+                cur = con.execute("select s.file from skipped s join requested r on s.file = r.file")
+                skipped = [f for f, in cur]
+        finally:
+            con.close()
+        return headers, skipped
+
+    def cached_paths(self) -> np.ndarray:
+        con = self._connect()
+        try:
+            cur = con.execute("select distinct file from headers union select file from skipped")
+            return np.array([f for f, in cur], dtype=str)
+        finally:
+            con.close()
+
+    """
+    Given the (file, mtime, size) of files on disk, returns those whose modification time or
+    size doesn't match what was recorded when they were cached (including files that have
+    never been cached), in their original order.
+    """
+    def stale(self, manifest) -> list[tuple[str, float, int]]:
+        con = self._connect()
+        try:
+            with con:
+                con.execute("create temp table scanned(file varchar primary key, mtime real, size integer)")
+                con.executemany("insert or ignore into scanned(file, mtime, size) values (?, ?, ?)", manifest)
+                cur = con.execute(
+                    "select s.file, s.mtime, s.size from scanned s left join manifest m on s.file = m.file "
+                    "where m.file is null or m.mtime != s.mtime or m.size != s.size order by s.rowid"
+                )
+                return cur.fetchall()
+        finally:
+            con.close()
+
     def set(self, headers, skipped):
+        self.insert_iter(headers, skipped)
+
+    """
+    Adds `headers`, an iterable of (file, key, value) rows, and the list of `skipped` files
+    to the cache, replacing any existing values for the same file and key, along with the
+    (file, mtime, size) `manifest` of the files they were read from. The rows are streamed 
+    into a single transaction, so `headers` can be a generator and never needs to be held 
+    in memory.
+    """
+    def insert_iter(self, headers, skipped = (), manifest = ()):
+        con = self._connect()
+        try:
+            con.execute("pragma cache_size = -65536")
+            with con:
+                con.executemany("insert or replace into headers(file, key, value) values (?, ?, ?)", headers)
+                con.executemany("insert or replace into skipped(file) values (?)", ((v,) for v in skipped))
+                con.executemany("insert or replace into manifest(file, mtime, size) values (?, ?, ?)", manifest)
+            con.execute("pragma optimize")
+        finally:
+            con.close()
+
+    """
+    Removes everything cached for `files`, so they're re-read on the next scan.
+    """
+    def invalidate(self, files):
         con = self._connect()
         try:
-            Cache._mktables(con, reset=True)
             with con:
-                con.executemany("insert into headers(file, key, value) values (?, ?, ?)", headers)
-                con.executemany("insert into skipped(file) values (?)", [(v,) for v in skipped])
+                con.executemany("delete from headers where file = ?", ((f,) for f in files))
+                con.executemany("delete from skipped where file = ?", ((f,) for f in files))
+                con.executemany("delete from manifest where file = ?", ((f,) for f in files))
         finally:
             con.close()
 
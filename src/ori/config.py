@@ -3,15 +3,26 @@ from importlib.resources import files
 from pathlib import Path
 import yaml
 import collections.abc
+import copy
+import functools
 from collections import UserDict
 
+try:
+    from yaml import CSafeLoader as _SafeLoader
+except ImportError:
+    from yaml import SafeLoader as _SafeLoader
+
 def attrlist_constructor(loader: yaml.SafeLoader, node: yaml.nodes.SequenceNode):
     return [v.upper() if isinstance(v, str) else v for v in loader.construct_sequence(node)]
 
+# Subclassed so the custom tag isn't registered on the global yaml.SafeLoader
+class OriLoader(_SafeLoader):
+    pass
+
+OriLoader.add_constructor("!attrs", attrlist_constructor)
+
 def get_loader():
-    loader = yaml.SafeLoader
-    loader.add_constructor("!attrs", attrlist_constructor)
-    return loader
+    return OriLoader
 
 def _update(target, source):
     for k, v in source.items():
@@ -24,10 +35,15 @@ def _update(target, source):
 def get_user_config_path():
     return Path(appdirs.user_config_dir(appname="ori"))
 
-def get_default_config():
+@functools.lru_cache(maxsize=1)
+def _load_default_config():
     with open(files('ori').joinpath('config.yaml'), 'rb') as _config:
         return yaml.load(_config, Loader=get_loader())
 
+def get_default_config():
+    # Copied since the merge with the user config shares (and can then modify) its values
+    return copy.deepcopy(_load_default_config())
+
 def get_config():
     user_config_path = get_user_config_path()
     if not user_config_path.exists():
@@ -3,6 +3,9 @@ from pathlib import Path
 import logging
 import shutil
 from datetime import datetime
+import functools
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import inspect
 import warnings
 import os
 
@@ -17,25 +20,87 @@ from .config import get_config
 
 tqdm.pandas()
 
-def headers_to_df(headers: list(tuple[str, str, str])) -> pd.DataFrame:
-    df = pd.DataFrame(headers, columns = ['file', 'attr', 'value'])
-    df = df[~df.attr.isin(['COMMENT','HISTORY','NOTE'])]
-    df = df.pivot(index='file', columns='attr', values = 'value').reset_index()
-    return df
+# Characters removed or replaced in attribute values used as parts of new filenames
+_NAMEPART_TRANS = str.maketrans({' ': '', ':': '-', '_': '-'})
+
+# Status of calibration frames, from the merge indicator of the targets with the frames
+_CALIB_STATUS = {'both': 'Available', 'left_only': 'Missing'}
+
+"""
+Reshapes long-form headers into one row per file. `headers` is either a DataFrame with
+file/attr/value columns (as returned by Cache.get_for) or a list of (file, attr, value) tuples.
+Rather than pivoting, each (file, attr) pair is mapped to a cell from the integer codes of the
+file and attr labels, and the values are scattered straight into a files x attrs array.
+"""
+def headers_to_df(headers: pd.DataFrame | list(tuple[str, str, str])) -> pd.DataFrame:
+    if not isinstance(headers, pd.DataFrame):
+        headers = pd.DataFrame(headers, columns = ['file', 'attr', 'value'])
+    df = headers[~headers.attr.isin(['COMMENT','HISTORY','NOTE'])]
+    file_codes, files = pd.factorize(df.file, sort = True)
+    attr_codes, attrs = pd.factorize(df.attr, sort = True)
+    values = np.full((len(files), len(attrs)), np.nan, dtype = object)
+    values[file_codes, attr_codes] = df.value.to_numpy()
+    # Dictionary-encoded (categorical) file/attr columns factorize into categorical labels,
+    # but everything downstream expects plain ones. Values are left as objects, with NaN for
+    # missing cells, as pivot gives them
+    df = pd.DataFrame(
+        values, 
+        index = pd.Index(np.asarray(files, dtype = object), name = 'file'), 
+        columns = pd.Index(np.asarray(attrs, dtype = object), name = 'attr')
+    )
+    return df.reset_index()
+
+"""
+Fills missing values in a Series or DataFrame with `label`, first adding it to the categories
+of any categorical columns (which otherwise can't hold it).
+"""
+def fillna(values: pd.Series | pd.DataFrame, label) -> pd.Series | pd.DataFrame:
+    if isinstance(values, pd.DataFrame):
+        return values.apply(fillna, label = label)
+    if isinstance(values.dtype, pd.CategoricalDtype) and label not in values.cat.categories:
+        values = values.cat.add_categories(label)
+    return values.fillna(label)
+
+"""
+DataFrame.value_counts, but only counting the combinations of values that actually occur 
+(value_counts lists every combination of categories for categorical columns).
+"""
+def value_counts(df: pd.DataFrame, subset = None) -> pd.Series:
+    subset = df.columns.to_list() if subset is None else subset
+    return df.groupby(subset, observed=True).size().sort_values(ascending=False).rename('count')
+
+"""
+Memoizes an Index method on its arguments until the Index's version changes (i.e. until the
+rowmask, selected attributes or underlying DataFrame are modified). Generators are stored
+as lists so they can be replayed.
+"""
+def versioned_cache(method):
+    hashable = lambda v: tuple(v) if isinstance(v, list) else v
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        key = (method.__name__, self._version, *map(hashable, args), *((k, hashable(v)) for k, v in sorted(kwargs.items())))
+        if key not in self._attr_cache:
+            result = method(self, *args, **kwargs)
+            self._attr_cache[key] = list(result) if inspect.isgenerator(result) else result
+        return self._attr_cache[key]
+    return wrapper
+
 
 class Index(object):
 
+    _virtual_attrs = ['_CHANGED', '_newname', '_newpath']
+    _categorical_attrs = ['INSTRUME', '_IMAGETYP', '_BINNING', '_CCDTEMP', '_GAIN', '_OFFSET']
     _required_keys = ['INSTRUME', 'IMAGETYP', 'CCD-TEMP', 'DATE-OBS', 'EXPTIME', 'GAIN', 'XBINNING', 'YBINNING', 'OFFSET']
 
     def __init__(self, headers, target_dir, index_key='file', missing_label = '(Unknown)'):
 
-        def normalize_temps(t):
-            if pd.isna(t):
-                return t
+        # Rounds temperatures to whole degrees, snapping to a common set-point within a degree
+        def normalize_temps(t: np.ndarray) -> np.ndarray:
             normal_temps = [0, -10, -15, -20]
-            if round(t)+1 in normal_temps: return round(t) + 1
-            if round(t)-1 in normal_temps: return round(t) - 1
-            return round(t)
+            # Adding 0 turns any -0.0 from rounding into 0.0
+            t = np.round(t) + 0.0
+            return np.where(np.isin(t + 1, normal_temps), t + 1, np.where(np.isin(t - 1, normal_temps), t - 1, t))
         
         self.config = get_config()
 
@@ -44,37 +109,45 @@ class Index(object):
 
         df = headers_to_df(headers) 
         df = df.reindex(columns = list(set(df.columns.to_list() + base_columns)))
-        df['_CCDTEMP'] = df['CCD-TEMP'].astype('float').map(normalize_temps).map("{:g}C".format)
-        df['_GAIN'] = df['GAIN'].astype('float').map("{:1.0f}".format)
-        df['_OFFSET'] = df['OFFSET'].astype('float').map("{:1.0f}".format)
+        ccd_temps = pd.Series(normalize_temps(df['CCD-TEMP'].astype('float').to_numpy()), index = df.index)
+        df['_CCDTEMP'] = ccd_temps.astype('Int64').astype('string') + 'C'
+        df['_GAIN'] = df['GAIN'].astype('float').map("{:1.0f}".format, na_action = 'ignore')
+        df['_OFFSET'] = df['OFFSET'].astype('float').map("{:1.0f}".format, na_action = 'ignore')
         df['_DEC'] = df['DEC'].astype('float').round(2)
         df['_RA'] = df['RA'].astype('float').round(2)
         df['_LOCALDT'] = pd.to_datetime(df['DATE-OBS'], utc=True).dt.tz_convert(tz)
         df['_LOCALDATE'] = df['_LOCALDT'].dt.date
         df['_LOCALTIME'] = df['_LOCALDT'].dt.timetz
         df['_NIGHT'] = df._LOCALDT.round('D').dt.date.astype('string')
-        df['_BINNING'] = df[['XBINNING', 'YBINNING']].astype('str').agg('x'.join, axis=1) 
+        df['_BINNING'] = df['XBINNING'].astype('string') + 'x' + df['YBINNING'].astype('string') 
         df['_IMAGETYP'] = df['IMAGETYP'].str.replace(' Frame', '').str.lower()
-        df['_CHANGED'] = False        
-        df['_NAME'] = df.file.apply(lambda f: str(Path(f).name))
-        df['_PATH'] = df.file.apply(lambda f: str(Path(f).parent))
-        df['_newname'] = pd.NA
-        df['_newpath'] = pd.NA
+        parts = df.file.str.rpartition(os.sep)
+        df['_NAME'] = parts[2]
+        df['_PATH'] = parts[0]
+        # Low-cardinality attributes that are never edited are stored as categoricals, which 
+        # group and count much faster than strings
+        categorical = [c for c in self._categorical_attrs if c not in self.config['mutable']]
+        df[categorical] = df[categorical].astype('category')
 
         missing_session_info = df.SESSION.isna()
         if any(missing_session_info):
             df.loc[df.SESSION.isna(), ['SESSION']] = df.loc[df.SESSION.isna(), ['_NIGHT']]
-            df['_CHANGED'] = missing_session_info
 
         self._df = df.set_index(index_key)
+        self._version = 0
+        self._attr_cache = {}
+        # Files with unsaved changes, and pending new filenames/paths by file. These are exposed
+        # as the virtual _CHANGED, _newname and _newpath attributes, and only materialized as 
+        # columns when they're displayed
+        self._changed = set(df.loc[missing_session_info, index_key])
+        self._renames = {'_newname': {}, '_newpath': {}}
         self._missing_label = missing_label
-        self._rowmask = [True for _ in self.df.index]
+        self._rowmask = np.ones(len(self.df), dtype=bool)
         self._selected_attrs = []
         self.selected_attrs = self.config['defaults']
         self._root_dir = str(target_dir)
         self._cache = Cache(target_dir)
         self._index = index_key
-        self._cache_valid = True
         self._prev_rowmasks = []
  
 
@@ -86,6 +159,15 @@ class Index(object):
     @df.setter
     def df(self, newdf: pd.DataFrame):
         self._df = newdf.reset_index().set_index(self._index)
+        self._touch()
+
+    """
+    Marks the Index as modified, invalidating anything memoized with @versioned_cache. 
+    Needs to be called after any in-place change to the DataFrame.
+    """
+    def _touch(self):
+        self._version += 1
+        self._attr_cache.clear()
 
 
     #---- Rowmask Methods
@@ -95,16 +177,19 @@ class Index(object):
 
     @rowmask.setter
     def rowmask(self, new_mask):
+        new_mask = np.asarray(new_mask, dtype=bool)
         assert len(new_mask) == len(self._df)
-        if not any(new_mask):
+        if not new_mask.any():
             logging.warn("No rows selected")
         self._rowmask = new_mask
+        self._touch()
 
     def reset_rowmask(self):
-        self._rowmask = [True for _ in self.df.index]
+        self._rowmask = np.ones(len(self.df), dtype=bool)
+        self._touch()
 
     def stash_rowmask(self):
-        self._prev_rowmasks.append(self.rowmask)
+        self._prev_rowmasks.append(self.rowmask.copy())
 
     #---- Attribute selection Methods
     @property
@@ -113,34 +198,82 @@ class Index(object):
 
     @selected_attrs.setter
     def selected_attrs(self, new_attrs):
-        _selected_attrs = [attr for attr in list(dict.fromkeys(new_attrs)) if attr in self.df.columns]
+        _selected_attrs = [attr for attr in list(dict.fromkeys(new_attrs)) if attr in self.df.columns or attr in self._virtual_attrs]
         if len(_selected_attrs) < len(set(new_attrs)):
             logging.warn(f"Some attrs skipped as they were not present in any headers: {[_ for _ in new_attrs if _ not in _selected_attrs]}")
         if len(_selected_attrs) == 0:
             logging.warn("No attrs selected")
         self._selected_attrs = _selected_attrs
+        self._touch()
 
 
+    @versioned_cache
     def all_attrs(self, defaults = list()):
-        all_attrs = sorted(self.df.columns.to_list())
+        all_attrs = sorted(self.df.columns.to_list() + self._virtual_attrs)
         _defaults = [_ for _ in defaults if _ in all_attrs]
         return _defaults + [_ for _ in all_attrs if _ not in _defaults]
 
 
-    def _invalidate_cache(self):
-        self._cache.reset()
+    def _invalidate_cache(self, files):
+        self._cache.invalidate(files)
+
+
+    #---- Pending changes
+
+    """
+    Returns df.loc[rowmask, attrs] (all attributes if attrs is None), computing any of the 
+    virtual _CHANGED/_newname/_newpath attributes from the pending changes.
+    """
+    def _select(self, rowmask, attrs = None) -> pd.DataFrame:
+        if attrs is None:
+            df = self.df.loc[rowmask]
+            attrs = df.columns.to_list() + self._virtual_attrs
+        else:
+            df = self.df.loc[rowmask, [a for a in attrs if a not in self._virtual_attrs]]
+        virtual = {
+            a: df.index.isin(self._changed) if a == '_CHANGED' else df.index.map(self._renames[a]) 
+            for a in attrs if a in self._virtual_attrs
+        }
+        return df.assign(**virtual)[attrs]
+
+    def n_changed(self):
+        return len(self._changed)
+
+    def has_renames(self, attr = None):
+        if attr is None:
+            return any(len(renames) > 0 for renames in self._renames.values())
+        return len(self._renames[attr]) > 0
+
+    def _set_renames(self, renames: pd.DataFrame):
+        for attr in renames.columns:
+            missing = renames[attr].isna()
+            for file in renames.index[missing]:
+                self._renames[attr].pop(file, None)
+            self._renames[attr].update(renames.loc[~missing, attr].to_dict())
+        self._touch()
+
+    def _clear_renames(self, file):
+        for renames in self._renames.values():
+            renames.pop(file, None)
 
 
     #---- Attribute values
 
+    """
+    Returns the row positions (within the current selection) of each value of `attr`, with
+    missing values grouped under the missing label. Computed once per version, so the same 
+    grouping is shared between listing the values and filtering the selection by them.
+    """
+    @versioned_cache
+    def _groups(self, attr) -> dict[object, np.ndarray]:
+        values = fillna(self._select(self.rowmask, [attr])[attr], self._missing_label)
+        return values.groupby(values, sort=False, observed=True).indices
+
+    @versioned_cache
     def values_for_attr(self, attr):
-        selection = self.df.loc[self.rowmask].copy()
-        values = selection[attr].fillna(self._missing_label)
-        for value in values.unique():
-            if value == self._missing_label:
-                _df = selection[selection[attr].isna()].reset_index()
-            else:
-                _df = selection[selection[attr] == value].reset_index()
+        selection = self._select(self.rowmask)
+        for value, rows in self._groups(attr).items():
+            _df = selection.iloc[rows].reset_index()
             
             nfiles = _df.file.nunique()
             ncombos = _df.drop(columns = 'file').drop_duplicates().shape[0]
@@ -151,9 +284,11 @@ class Index(object):
                 'nfiles': nfiles
             }
 
+    # Memoized like the other derived values, since the App reads it several times per prompt
     @property
+    @versioned_cache
     def selection(self) -> pd.DataFrame:
-        return self.df.loc[self._rowmask, self._selected_attrs]
+        return self._select(self._rowmask, self._selected_attrs)
 
     @selection.setter
     def selection(self, new_selection: pd.DataFrame):
@@ -161,19 +296,22 @@ class Index(object):
         self.selected_attrs = new_selection.columns
         return self
 
+    @versioned_cache
     def summary(self, missing_label = ' ∅'):
-        selection = self.df[self.rowmask].copy()
-        selection.loc[selection.IMAGETYP.isin(['Bias Frame','Dark Frame']), ['OBJECT', 'FILTER']] = np.nan
-        selection.loc[selection.IMAGETYP == 'Flat Frame', ['CCD-TEMP', 'OBJECT']] = np.nan
-        selection = selection.fillna(missing_label)
         if len(self.selected_attrs) == 0:
             print("No attributes selected, using default attributes")
             group_keys = [_ for _ in self.config['defaults'] if _ not in ['_PATH', 'EXPTIME']]
         else:
             group_keys = self.selected_attrs
+        # Only the grouped attributes and the ones blanked out below are needed
+        attrs = list(dict.fromkeys(group_keys + ['EXPTIME', 'IMAGETYP', 'OBJECT', 'FILTER', 'CCD-TEMP']))
+        selection = self._select(self.rowmask, attrs)
+        selection.loc[selection.IMAGETYP.isin(['Bias Frame','Dark Frame']), ['OBJECT', 'FILTER']] = np.nan
+        selection.loc[selection.IMAGETYP == 'Flat Frame', ['CCD-TEMP', 'OBJECT']] = np.nan
+        selection = fillna(selection, missing_label)
         if 'EXPTIME' not in group_keys:
             _group_exp = list(group_keys + ['EXPTIME'])
-            group = selection[_group_exp].groupby(group_keys)
+            group = selection[_group_exp].groupby(group_keys, observed=True)
             return (
                     group.agg(
                         SumExpTime = pd.NamedAgg('EXPTIME', lambda x: x.astype('float').sum()),
@@ -184,24 +322,30 @@ class Index(object):
             )
         else:
             return (
-                selection.value_counts(subset = group_keys).to_frame('# files')
+                value_counts(selection, subset = group_keys).to_frame('# files')
             )
 
 
+    @versioned_cache
     def problem_files(self):
-        selection = self.df[self.rowmask].copy()
         calib_attrs = self.config['calibration']
         catalog_attrs = self.config['catalog']
 
         def core_attrs(imgtype, exceptions = ['_GAIN_OFFSET', 'IMAGETYP', '_IMAGETYP', 'DATE-OBS']):
             attrs = calib_attrs.get(imgtype, {}).get('attrs', []) + catalog_attrs.get(imgtype, {}).get('path', []) + catalog_attrs.get(imgtype, {}).get('name', [])
             return list(dict.fromkeys(a for a in attrs if a not in exceptions))
+
+        # Only the attributes checked for the selected image types are needed
+        imgtypes = self.df.loc[self.rowmask, '_IMAGETYP'].dropna().unique()
+        attrs = [a for imgtype in imgtypes for a in core_attrs(imgtype)]
+        attrs = [a for a in dict.fromkeys(attrs + ['_PATH', '_IMAGETYP']) if a in self.df.columns]
+        selection = self.df.loc[self.rowmask, attrs]
         
-        for imgtype, _df in selection.groupby(['_IMAGETYP'], as_index=False):
+        for imgtype, _df in selection.groupby(['_IMAGETYP'], as_index=False, observed=True):
             attrs = core_attrs(imgtype)
             _df = _df[attrs + ['_PATH']]
-            missing = _df.apply(lambda row: any(row.isna()), axis=1)
-            yield imgtype, attrs + ['_PATH', '_IMAGETYP'], _df[missing].fillna('<!>')
+            missing = _df.isna().any(axis=1)
+            yield imgtype, attrs + ['_PATH', '_IMAGETYP'], fillna(_df[missing], '<!>')
 
 
     def files(self):
@@ -214,7 +358,8 @@ class Index(object):
             mask = self.df.index.isin(files)
         else:
             raise ValueError("At least one of mask or files needs to be specified")
-        self.df['_CHANGED'] = mask | self.df['_CHANGED']            
+        self._changed.update(self.df.index[np.asarray(mask, dtype=bool)])
+        self._touch()
         
 
     def _change_attr(self, attr, value):
@@ -224,14 +369,16 @@ class Index(object):
             self.df[attr] = pd.NA
             changed_values = self.rowmask
 
-        self.df.loc[self.rowmask, [attr]] = value
+        self.df.loc[self.rowmask, attr] = value
+        # _update_changed_vec marks the Index as modified
         self._update_changed_vec(mask = changed_values)
         if attr not in self.selected_attrs:
             self.selected_attrs += [attr]
 
 
+    @versioned_cache
     def changed(self) -> pd.DataFrame:
-        return self.df[self.df['_CHANGED']]
+        return self.df[self.df.index.isin(self._changed)]
 
 
     def _calibration_(self, IMAGETYP):
@@ -245,11 +392,11 @@ class Index(object):
         c_attrs = c_data['attrs']
         c_targets = c_data['targets']
         calib_files = self.df[self.df._IMAGETYP == c_type].reset_index()[c_attrs + [self.df.index.name]]
-        df = self.df[self.rowmask].copy()
+        df = self.df.loc[self.rowmask, list(dict.fromkeys(c_attrs + ['_IMAGETYP']))]
         target_files = df[df._IMAGETYP.isin(c_targets)].reset_index()[c_attrs].drop_duplicates().dropna()
         #target_files = self.df[self.rowmask].query(f"_IMAGETYP in @target_types").reset_index()[c_attrs].drop_duplicates().dropna()
-        calib_files = pd.merge(target_files, calib_files, how = 'outer', indicator = True).query('_merge.isin(["both", "left_only"])')
-        calib_files = calib_files.assign(_STATUS = lambda x: [{'both':'Available', 'left_only':'Missing'}[_] for _ in x._merge]).drop(columns = '_merge').set_index(self._index)
+        calib_files = pd.merge(target_files, calib_files, how = 'outer', indicator = True).loc[lambda x: x._merge != 'right_only']
+        calib_files = calib_files.assign(_STATUS = lambda x: x._merge.map(_CALIB_STATUS)).drop(columns = '_merge').set_index(self._index)
         return calib_files
 
     def calibration_frames2(self, c_type, exp_tolerance = 2, temp_tolerance = 0):
@@ -257,22 +404,21 @@ class Index(object):
         c_data = self.config['calibration'][c_type]
         c_attrs = c_data['attrs']
         c_targets = c_data['targets']
-        df = self.df.copy()
-        df = df.assign(
+        df = self.df.assign(
             EXPTIME = lambda df: df.EXPTIME.astype('float').round(exp_tolerance),
             _CCDTEMP = lambda df: df['CCD-TEMP'].astype('float').round(temp_tolerance)
         )
         c_files = df.loc[df._IMAGETYP == c_type, c_attrs].reset_index()
         t_files = df.loc[self.rowmask & df._IMAGETYP.isin(c_targets)].reset_index()[c_attrs].drop_duplicates().dropna()
-        c_files = pd.merge(t_files, c_files, how = 'outer', indicator = True).query('_merge.isin(["both", "left_only"])')
-        c_files = c_files.assign(_STATUS = lambda x: [{'both':'Available', 'left_only':'Missing'}[_] for _ in x._merge]).drop(columns = '_merge').set_index(self._index)
+        c_files = pd.merge(t_files, c_files, how = 'outer', indicator = True).loc[lambda x: x._merge != 'right_only']
+        c_files = c_files.assign(_STATUS = lambda x: x._merge.map(_CALIB_STATUS)).drop(columns = '_merge').set_index(self._index)
         return c_files
 
 
 
     """
-    Syncs updated attributes and moves/copies files as defined by the _newpath and _newname 
-    virtual attributes.
+    Syncs updated attributes and moves/copies files as defined by the pending renames (the
+    _newpath and _newname virtual attributes).
     - op: if 'copy', write changes to a copy whose path is determined by _newpath/_newname. The updated
         file is not added to the Index. If 'move', write changes to original file and move it. The updated 
         file replaces the previous one in the Index. If 'symlink', create a symlink from the original file 
@@ -281,6 +427,9 @@ class Index(object):
     """         
     def sync(self, op = True, overwrite_existing = False, save_oldname = False):
 
+        # Date stamped on the HISTORY cards of every file written in this sync
+        today = datetime.now().date()
+
         def _move_copy_or_symlink(op, file, newfile: Path):
             if not newfile.parent.exists():
                 newfile.parent.mkdir(parents = True, exist_ok=True)
@@ -293,7 +442,7 @@ class Index(object):
             return newfile
 
         def _add_oldname(header, oldname, newname):
-            header.add_history(f'({datetime.now().date()}) filename: {oldname} -> {newname}')
+            header.add_history(f'({today}) filename: {oldname} -> {newname}')
             return header
 
         def _update_header(row, header: fits.Header, to_update = self.config['mutable']):
@@ -301,18 +450,29 @@ class Index(object):
             for key, new_value in new_values.copy().items():
                 old_value = header.get(key)
                 if str(old_value) != str(new_value):
-                    header.add_history(f'({datetime.now().date()}) {key}: {old_value} -> {new_value}')
+                    header.add_history(f'({today}) {key}: {old_value} -> {new_value}')
                 if key == 'SESSION':
                     new_values[key] = str(new_value)
                 
             header.update(new_values)
             return header
 
+        def _write_header(newfile, row, oldname, newname, changed):
+            with fits.open(newfile, mode='update', output_verify = 'silentfix+ignore' ) as fitsfile:
+                header = fitsfile[0].header
+                if newname != oldname:
+                    header = _add_oldname(header, oldname, newname)
+                if changed:
+                    header = _update_header(row, header)
+                fitsfile[0].header = header
+                fitsfile.flush(output_verify='silentfix+ignore')
+
         def _sync_row(row):
+            changed = row.file in self._changed
             oldpath = row._PATH
             oldname = row._NAME
-            newpath = row._newpath if not pd.isna(row._newpath) else oldpath
-            newname = row._newname if not pd.isna(row._newname) else oldname
+            newpath = self._renames['_newpath'].get(row.file, oldpath)
+            newname = self._renames['_newname'].get(row.file, oldname)
             newfile = Path(newpath, newname)
             do_rename = (newpath != oldpath) or (newname != oldname)
             if do_rename:
@@ -320,51 +480,71 @@ class Index(object):
                     print(f"Error: desired filename already exists ({newfile})")
                     return
                 newfile = _move_copy_or_symlink(op, row.file, newfile)
-                self.df.loc[self.df.index == row.file, ['_newpath', '_newname']] = pd.NA
+                self._clear_renames(row.file)
         
             if not op == 'symlink':
-                if ((newname != oldname) & save_oldname) or row._CHANGED:
-                    with warnings.catch_warnings():
-                        warnings.simplefilter('ignore', AstropyUserWarning)
-                        with fits.open(newfile, mode='update', output_verify = 'silentfix+ignore' ) as fitsfile:
-                            header = fitsfile[0].header
-                            if newname != oldname:
-                                header = _add_oldname(header, oldname, newname)
-                            if row._CHANGED:
-                                header = _update_header(row, header)
-                            fitsfile[0].header = header
-                            fitsfile.flush(output_verify='silentfix+ignore')
-
-                self.df.loc[self.df.index == row.file, ['_CHANGED']] = False
+                # The file's key in the index once it's been synced
+                key = row.file
+                synced_files.append(row.file)
                 if op == 'move':
                     self.df.loc[self.df.index == row.file, ['_path']] = newpath
                     self.df.rename(index = {row.file:newfile}, inplace = True)
-            
-                if row._CHANGED and not do_rename:
-                    if not do_rename:
-                        # invalidate cache since the headers have changed but the paths have not
-                        self._cache_valid = False
+                    key = newfile
 
-        self.changed().reset_index().progress_apply(_sync_row, axis=1)
-        
-        if not self._cache_valid:
-            self._invalidate_cache()
+                if ((newname != oldname) & save_oldname) or changed:
+                    # apply() can reuse the same Series for each row, so keep a copy
+                    header_updates.append((key, (newfile, row.copy(), oldname, newname, changed)))
+            
+                if changed and not do_rename:
+                    # invalidate cached headers since they have changed but the paths have not
+                    stale_files.append(row.file)
+
+        stale_files = []
+        synced_files = []
+        header_updates = []
+        written = set()
+        try:
+            # Files in the same directory are handled together, which is kinder to the filesystem's caches
+            self.changed().reset_index().sort_values(['_PATH', '_NAME']).progress_apply(_sync_row, axis=1)
+
+            # Moves/copies are done, so every header update is to a different file and they can be
+            # written in parallel (the writes are I/O bound). The warning filter is process-wide, so
+            # it's set here rather than in each thread
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', AstropyUserWarning)
+                with ThreadPoolExecutor(max_workers = 8) as ex:
+                    futures = {ex.submit(_write_header, *update): key for key, update in header_updates}
+                    for future in tqdm(as_completed(futures), total = len(futures), unit = ' files', desc = 'Updating headers'):
+                        if future.exception() is None:
+                            written.add(futures[future])
+                        else:
+                            logging.error(f"Could not update header of {futures[future]}: {future.exception()}")
+        finally:
+            # Files whose header wasn't written still have unsaved changes, under their new key
+            failed = [key for key, _ in header_updates if key not in written]
+            self._changed.difference_update(synced_files)
+            self._changed.update(failed)
+            self._touch()
+            if len(stale_files) > 0:
+                self._invalidate_cache(stale_files)
+
+        if len(failed) > 0:
+            print(f"Error: could not update the headers of {len(failed)} files; their changes are still unsaved")
 
 
     def change_subtree(self, destination):
-        df = self.df.reset_index()
-        
-        def _new_subtree(file):
-            try:
-                path = str(Path(destination, Path(file).relative_to(self._root_dir).parent))
-                return path
-            except ValueError as e:
-                logging.warn(f"Skipping {file} as it is not in original target directory")
-                return pd.NA
-
-        df.loc[self.rowmask, ['_newpath']] = df.loc[self.rowmask].apply(lambda row: _new_subtree(row.file), axis=1)
-        df.loc[self.rowmask, ['_CHANGED']] = True
-        self.df = df
+        root = self._root_dir + os.sep
+        files = self.df.index[self.rowmask]
+        outside = ~files.str.startswith(root)
+        for file in files[outside]:
+            logging.warn(f"Skipping {file} as it is not in original target directory")
+
+        # Parent directory of each file relative to the target directory ('' for the top level)
+        subdir = pd.Series(files.str.slice(len(root)), index = files).str.rpartition(os.sep)[0]
+        destination = str(Path(destination))
+        newpath = (destination + os.sep + subdir).where(subdir != '', destination).mask(outside, pd.NA)
+        self._changed.update(files)
+        self._set_renames(pd.DataFrame({'_newpath': newpath}))
         
 
     def organize(self, root_dir, structure_key = 'catalog'):
@@ -384,59 +564,58 @@ class Index(object):
             attrs = set(attrs['path'] + attrs['name'] + ['DATE-OBS', '_IMAGETYP'])
             return [_ for _ in attrs if _ not in ignored]
 
-        def _get_new_name(row):
+        # The new names and paths are built a column at a time, since every file in a group 
+        # shares the same image type (and so the same name and path attributes)
+        def _get_new_names(df, imgtype):
             def namepart(attr):
-                part = str(row[attr]).replace(' ', '').replace(':', '-').replace('_', '-')
+                missing = df[attr].isna().to_numpy()
+                part = df[attr].astype(str).mask(missing, 'unknown').str.translate(_NAMEPART_TRANS)
                 if attr in ['_GAIN', '_OFFSET']:
                     part = attr.strip('_').lower() + part
                 return part
-            attrs = attr_structure[row._IMAGETYP]['name'] 
+            attrs = attr_structure[imgtype]['name'] 
             if len(attrs) == 0:
-                return pd.NA
+                return pd.Series(pd.NA, index = df.index)
             else:
-                attrs = attrs + ['_SEQNO']
-                return '_'.join(namepart(attr) for attr in attrs) + '.fits'
+                parts = [namepart(attr) for attr in attrs + ['_SEQNO']]
+                return parts[0].str.cat(parts[1:], sep = '_') + '.fits'
             
 
-        def _get_new_path(row):
+        def _get_new_paths(df, imgtype):
             def subdir(attr):
-                value = row[attr]
+                value = df[attr]
                 key = attr.lower().strip('_')
-                if pd.isna(value) or value == 'nan' or value == self._missing_label:
-                    value = f'unknown {key}'    
+                unknown = (value.isna() | value.isin([self._missing_label])).to_numpy()
+                value = value.astype(str).mask(unknown, f'unknown {key}')
                 if key in ['binning', 'gain', 'offset']:
-                    value = key + '-' + value.replace(' ', '')
+                    value = key + '-' + value.str.replace(' ', '')
                 return value
-            attrs = attr_structure[row._IMAGETYP]['path']
-            return str(Path(root_dir, Path(*[subdir(attr) for attr in attrs])))
-            # return str(Path(root_dir, Path(*[str(row[s]).replace(' ', '_') for s in attr_structure[row._IMAGETYP]['path']])))
+            path = pd.Series(str(Path(root_dir)), index = df.index)
+            for attr in attr_structure[imgtype]['path']:
+                path = path + os.sep + subdir(attr)
+            return path
 
-        img_groups = self.df[self.rowmask].groupby('_IMAGETYP', as_index=False)
+        img_groups = self.df[self.rowmask].groupby('_IMAGETYP', as_index=False, observed=True)
         for imgtype, _df in img_groups:
             base_attrs = _required_attrs(imgtype)
             group_attrs = [_ for _ in attr_structure[imgtype]['name'] if _ not in ['DATE-OBS', '_SEQNO']]
 
-            df = self.df.loc[self.df.index.isin(_df.index), base_attrs]
+            # The group already holds these rows in index order, so there's no need to look them up again
+            df = _df[base_attrs].copy()
             
             if 'EXPTIME' in base_attrs:
-                df['EXPTIME'] = df.EXPTIME.astype('float').map('{:g}s'.format)
+                df['EXPTIME'] = df.EXPTIME.astype('float').map('{:g}s'.format, na_action = 'ignore')
 
             if len(group_attrs) > 0:
-                df['_SEQ'] = df.groupby(group_attrs)['DATE-OBS'].rank('dense')
+                df['_SEQ'] = df.groupby(group_attrs, observed=True)['DATE-OBS'].rank('dense')
                 df['_SEQNO'] = df._SEQ.map('{:1.0f}'.format).str.zfill(3)
             
-            df['_newname'] = df.apply(_get_new_name, axis=1)
-            df['_newpath'] = df.apply(_get_new_path, axis=1)
-
-            if '_newname' not in self.df.columns:
-                self.df['_newname'] = pd.NA
-            if '_newpath' not in self.df.columns:
-                self.df['_newpath'] = pd.NA
-
-            df = df.reset_index().set_index(self._index)
+            df['_newname'] = _get_new_names(df, imgtype)
+            df['_newpath'] = _get_new_paths(df, imgtype)
 
-            self.df.loc[self.df.index.isin(df.index), ['_newname', '_newpath']] = df[['_newname', '_newpath']]
-            self.df.loc[self.df.index.isin(df.index), ['_CHANGED']] = True
+            self._set_renames(df[['_newname', '_newpath']])
+            self._changed.update(df.index)
+        self._touch()
 
 
 
@@ -447,7 +626,7 @@ class Index(object):
         self.df.index.map()
 
     def fill_missing_sessions(self):
-        missing = self.df.SESSION.isna()
-        self.df['SESSION'] = self.df['_NIGHT']
+        missing = self.df.SESSION.isna().to_numpy()
+        self.df.loc[missing, 'SESSION'] = self.df.loc[missing, '_NIGHT']
         self._update_changed_vec(mask=missing)
 
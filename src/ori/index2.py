@@ -57,9 +57,47 @@ class SqlIndex(object):
 
     base = Base
 
+    """
+    Bulk-loads `df` into `tbl_name`. pandas only creates (or replaces) the table; the rows
+    are inserted with a single executemany on the raw SQLite connection, in one transaction
+    with syncing and the rollback journal kept out of the way for the duration of the load.
+    """
     @staticmethod
     def df_to_sql(df: pd.DataFrame, tbl_name, engine, if_exists):
-        df.to_sql(name = tbl_name, con = engine, if_exists = if_exists, index=False)
+        df.head(0).to_sql(name = tbl_name, con = engine, if_exists = if_exists, index=False)
+        if len(df) == 0:
+            return
+        
+        columns = ', '.join('"{}"'.format(str(c).replace('"', '""')) for c in df.columns)
+        placeholders = ', '.join(['?'] * len(df.columns))
+        insert = f'INSERT INTO "{tbl_name}" ({columns}) VALUES ({placeholders})'
+        # sqlite3 can't bind numpy scalars, timestamps or NaN, so hand it Python objects and None.
+        # Datetimes are written as strings in the format SQLAlchemy's DateTime uses on SQLite
+        values = df.copy()
+        for col in values.columns[[pd.api.types.is_datetime64_any_dtype(t) for t in values.dtypes]]:
+            values[col] = values[col].dt.strftime('%Y-%m-%d %H:%M:%S.%f')
+        rows = values.astype(object).where(values.notna(), None).itertuples(index=False, name=None)
+
+        conn = engine.raw_connection()
+        try:
+            cursor = conn.cursor()
+            pragmas = ('synchronous', 'journal_mode', 'temp_store')
+            previous = {p: cursor.execute(f"PRAGMA {p}").fetchone()[0] for p in pragmas}
+            cursor.execute("PRAGMA synchronous = OFF")
+            cursor.execute("PRAGMA journal_mode = MEMORY")
+            cursor.execute("PRAGMA temp_store = MEMORY")
+            try:
+                cursor.executemany(insert, rows)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                for p in pragmas:
+                    cursor.execute(f"PRAGMA {p} = {previous[p]}")
+                cursor.close()
+        finally:
+            conn.close()
     
     """
     Create a new, SQLite-based FITS index.
@@ -93,7 +131,7 @@ if __name__ == "__main__":
         index = SqlIndex(target_dir)
     else:
         files = find_fits(target_dir, days = args.days_old, allow_siril=args.allow_siril)
-        header_dict, skipped = parse_files(files)
+        header_dict, skipped = parse_files(files, cache_file = Path(target_dir, 'index.db'))
         header_df = pd.DataFrame(header_dict)
         index = SqlIndex(target_dir, header_df = header_df)
 
@@ -1,36 +1,76 @@
 import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from tqdm import tqdm
 from datetime import datetime 
-import subprocess
+import time
+import hashlib
+import json
+import sqlite3
 
 from astropy.io import fits
 
-def is_valid(f: Path, allow_siril: bool):
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+def is_valid(name: str, is_symlink: bool, allow_siril: bool):
     if allow_siril:
-        return not (f.is_symlink())
+        return not is_symlink
     else:
-        return not (f.is_symlink() or f.name.startswith('r_') or f.name.startswith('pp_'))
-
-def find_fits(target_dir: Path, pattern = "*.fit*", days = None, allow_siril = False):
-    if days is not None:
-        cmd = subprocess.run(
-            ['find', str(target_dir), '-mtime', f'-{days}', '-name', pattern], 
-            stdout=subprocess.PIPE, text=True
-        )
-        return [str(f) for f in cmd.stdout.splitlines() if is_valid(Path(str(f)), allow_siril)]
+        return not (is_symlink or name.startswith(('r_', 'pp_')))
+
+FITS_EXTENSIONS = ('.fit', '.fits', '.fts', '.fit.fz', '.fits.fz', '.fts.fz')
+
+"""
+Iteratively walks `root` with os.scandir, yielding the DirEntry of each FITS file. Symlinks
+(to files or directories) are skipped, as are Siril's preprocessed files (r_*, pp_*)
+unless `allow_siril` is set. If `since` is given, only files modified after that
+timestamp are returned.
+"""
+def _walk_fits(root: str, allow_siril: bool, since: float = None):
+    stack = [root]
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except OSError:
+            continue
+        with entries:
+            for e in entries:
+                if e.is_dir(follow_symlinks=False):
+                    stack.append(e.path)
+                elif e.name.endswith(FITS_EXTENSIONS) and is_valid(e.name, e.is_symlink(), allow_siril):
+                    if since is not None and e.stat(follow_symlinks=False).st_mtime < since:
+                        continue
+                    yield e
+
+def find_fits(target_dir: Path, days = None, allow_siril = False):
+    since = time.time() - days * 86400 if days is not None else None
+    return [e.path for e in tqdm(_walk_fits(str(target_dir), allow_siril, since), unit = ' files')]
+
+"""
+Returns a 64-bit hash of `data`, as a signed integer so it fits in an SQLite INTEGER column.
+Uses xxHash when installed, and BLAKE2 otherwise.
+"""
+def hash64(data: bytes) -> int:
+    if xxhash is not None:
+        digest = xxhash.xxh3_64_digest(data)
     else:
-        return [str(f) for f in tqdm(target_dir.rglob(pattern), unit = ' files') if is_valid(f, allow_siril)]   
+        digest = hashlib.blake2b(data, digest_size = 8).digest()
+    return int.from_bytes(digest, 'big', signed = True)
 
 """
 Returns a tidy key:value dictionary of a FITS header, along with an id 
-computed from a hash of the non-comment/history fields.
+computed from a hash of the raw header cards. Unlike Python's hash(), the id is the 
+same from one run to the next.
 """
 def parse_header(header: fits.Header) -> dict:
     comment = '\n'.join(header.get('COMMENT', []))
     history = '\n'.join(header.get('HISTORY', []))
     date_obs = datetime.fromisoformat(header.get('DATE-OBS'))
-    id = hash(frozenset(header.values()))
+    id = hash64(header.tostring().encode('ascii', 'replace'))
     return {
         'id':id, 
         'comment': comment, 
@@ -38,18 +78,126 @@ def parse_header(header: fits.Header) -> dict:
         'date_obs':date_obs, 
         **{k.replace('-', '_').lower(): v for k,v in header.items() if k not in ['HISTORY', 'COMMENT', 'DATE-OBS']}}
     
+def _parse_one(file: str) -> tuple[dict, str]:
+    try:
+        # Only the primary header is needed, so don't read past it or scale any data
+        with fits.open(file, memmap = True, lazy_load_hdus = True, do_not_scale_image_data = True) as hdul:
+            header = hdul[0].header.copy()
+        path, name = os.path.split(file)
+        return {**parse_header(header), 'name': name, 'path': path}, None
+    except OSError as e:
+        logging.info(f"Could not parse header for {file}: {e}")
+        return None, file
+
 """
-Parses a list of files into a list of dictionaries from the parsed headers and file info. 
-Files whose headers could not be parsed are returned in a separate list.
+Memoizes parsed header rows in the `header_cache` table of the SQLite database at `db_file`
+(the index.db used by SqlIndex), keyed on each file's path, modification time and size, so
+unchanged files don't need to be re-read. Rows are stored as JSON. Bump `_schema_version`
+whenever the rows returned by parse_header change, so that stale rows are thrown away.
 """
-def parse_files(files: list[str]) -> tuple[list[dict], list[str]]:
-    rows, skipped = list(), list()
-    for file in tqdm(files, unit = ' files', desc = 'Reading headers'):
-        file = Path(file)
+class HeaderCache(object):
+    _schema_version = 2
+
+    def __init__(self, db_file):
+        self._db_file = str(db_file)
+        con = sqlite3.connect(self._db_file)
         try:
-            header = fits.getheader(file)
-            rows.append({**parse_header(header), 'name': file.name, 'path': str(file.parent)})
-        except OSError as e:
-            logging.info(f"Could not parse header for {file}: {e}")
-            skipped.append(str(file))
-    return rows, skipped
\ No newline at end of file
+            with con:
+                version, = con.execute("pragma user_version").fetchone()
+                if version != HeaderCache._schema_version:
+                    con.execute("drop table if exists header_cache")
+                    con.execute(f"pragma user_version = {HeaderCache._schema_version}")
+                con.execute(
+                    "create table if not exists header_cache(path varchar primary key, mtime integer, size integer, row text) without rowid"
+                )
+        finally:
+            con.close()
+
+    @staticmethod
+    def _dumps(row: dict) -> str:
+        # date_obs is stored as an ISO string and astropy's Undefined (for keywords without
+        # a value) as null. Anything else JSON can't hold, e.g. complex values, is stored as text
+        def default(value):
+            if isinstance(value, datetime):
+                return value.isoformat()
+            if isinstance(value, fits.card.Undefined):
+                return None
+            return str(value)
+        return json.dumps(row, default = default)
+
+    @staticmethod
+    def _loads(row: str) -> dict:
+        row = json.loads(row)
+        if row.get('date_obs') is not None:
+            row['date_obs'] = datetime.fromisoformat(row['date_obs'])
+        return row
+
+    """
+    Returns the cached rows for the files in `stats`, a dict of path -> (mtime, size), whose
+    modification time and size still match.
+    """
+    def get(self, stats: dict[str, tuple[int, int]]) -> dict[str, dict]:
+        con = sqlite3.connect(self._db_file)
+        try:
+            with con:
+                con.execute("create temp table requested(path varchar primary key, mtime integer, size integer)")
+                con.executemany("insert or ignore into requested(path, mtime, size) values (?, ?, ?)", ((f, *st) for f, st in stats.items()))
+                cur = con.execute(
+                    "select c.path, c.row from header_cache c join requested r on c.path = r.path and c.mtime = r.mtime and c.size = r.size"
+                )
+                return {path: HeaderCache._loads(row) for path, row in cur}
+        finally:
+            con.close()
+
+    """
+    Stores `rows`, an iterable of (path, mtime, size, row), committing every `batch_size` rows.
+    """
+    def set(self, rows, batch_size = 1000):
+        con = sqlite3.connect(self._db_file)
+        try:
+            batch = []
+            for path, mtime, size, row in rows:
+                batch.append((path, mtime, size, HeaderCache._dumps(row)))
+                if len(batch) == batch_size:
+                    with con:
+                        con.executemany("insert or replace into header_cache(path, mtime, size, row) values (?, ?, ?, ?)", batch)
+                    batch = []
+            with con:
+                con.executemany("insert or replace into header_cache(path, mtime, size, row) values (?, ?, ?, ?)", batch)
+        finally:
+            con.close()
+
+
+def _stat(file: str):
+    try:
+        st = os.stat(file)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+"""
+Parses a list of files into a list of dictionaries from the parsed headers and file info,
+reading the headers in a pool of `max_workers` processes (defaults to the number of CPUs).
+Files whose headers could not be parsed are returned in a separate list. If `cache_file` 
+is given, parsed rows are memoized there (see HeaderCache) and only new or modified files 
+are read.
+"""
+def parse_files(files: list[str], max_workers = None, cache_file = None) -> tuple[list[dict], list[str]]:
+    rows, skipped = dict(), list()
+    stats = {f: st for f, st in zip(files, map(_stat, files)) if st is not None}
+    cache = HeaderCache(cache_file) if cache_file is not None else None
+    if cache is not None:
+        rows.update(cache.get(stats))
+    to_parse = [f for f in files if f not in rows]
+
+    with ProcessPoolExecutor(max_workers = max_workers) as ex:
+        results = ex.map(_parse_one, to_parse, chunksize = 32)
+        for file, (row, _) in tqdm(zip(to_parse, results), total = len(to_parse), unit = ' files', desc = 'Reading headers'):
+            if row is None:
+                skipped.append(file)
+            else:
+                rows[file] = row
+
+    if cache is not None:
+        cache.set((f, *stats[f], rows[f]) for f in to_parse if f in rows and f in stats)
+    return [rows[f] for f in files if f in rows], skipped
@@ -0,0 +1,64 @@
+import os
+
+import numpy as np
+from astropy.io import fits
+
+from ori.app import _manifest, parse_fits_headers
+from ori.cache import Cache
+
+
+def _write_fits(path, **cards):
+    header = fits.Header()
+    for key, value in cards.items():
+        header[key] = value
+    fits.PrimaryHDU(data = np.zeros((2, 2), dtype = np.uint16), header = header).writeto(path, overwrite = True)
+
+
+def _cached(tmp_path, names):
+    files = [str(tmp_path / name) for name in names]
+    for f in files:
+        _write_fits(f, OBJECT = 'M 31')
+    cache = Cache(tmp_path)
+    manifest = list(_manifest(files))
+    assert parse_fits_headers(files, cache, max_workers = 1, manifest = manifest) == []
+    return cache, files
+
+
+def test_nothing_stale_after_caching(tmp_path):
+    cache, files = _cached(tmp_path, ['a.fits', 'b.fits'])
+    assert cache.stale(_manifest(files)) == []
+
+
+def test_new_file_is_stale(tmp_path):
+    cache, files = _cached(tmp_path, ['a.fits'])
+    new = str(tmp_path / 'b.fits')
+    _write_fits(new, OBJECT = 'M 33')
+    assert [f for f, _, _ in cache.stale(_manifest(files + [new]))] == [new]
+
+
+def test_modified_file_is_stale(tmp_path):
+    cache, (a, b, c) = _cached(tmp_path, ['a.fits', 'b.fits', 'c.fits'])
+    # A new size...
+    _write_fits(b, OBJECT = 'M 33', **{f'KEY{i}': i for i in range(40)})
+    # ...or just a new modification time
+    st = os.stat(c)
+    os.utime(c, ns = (st.st_atime_ns, st.st_mtime_ns + 10**9))
+    assert [f for f, _, _ in cache.stale(_manifest([a, b, c]))] == [b, c]
+
+
+def test_removed_file_is_dropped(tmp_path):
+    cache, (a, b) = _cached(tmp_path, ['a.fits', 'b.fits'])
+    os.remove(a)
+    manifest = list(_manifest([a, b]))
+    assert [f for f, _, _ in manifest] == [b]
+    assert cache.stale(manifest) == []
+
+
+def test_reparsed_file_is_no_longer_stale(tmp_path):
+    cache, (a, b) = _cached(tmp_path, ['a.fits', 'b.fits'])
+    _write_fits(a, OBJECT = 'M 33', EXTRA = 1)
+    stale = cache.stale(_manifest([a, b]))
+    parse_fits_headers([f for f, _, _ in stale], cache, max_workers = 1, manifest = stale)
+    assert cache.stale(_manifest([a, b])) == []
+    headers, _ = cache.get_for([a])
+    assert dict(zip(headers.attr.astype(str), headers.value))['OBJECT'] == 'M 33'
@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from ori import _fastheader
+from ori._fastheader import BLOCK_SIZE, CARD_SIZE, fast_header, header_from_bytes
+
+CARDS = [
+    "SIMPLE  =                    T",
+    "BITPIX  =                    8",
+    "NAXIS   =                    0",
+    "OBJECT  = 'M 31/M 32'          / a quoted / isn't a comment",
+    "OBSERVER= 'O''Brien'           / doubled quotes",
+    "EMPTY   = ''",
+    "PADDED  = '  x  '",
+    "LONGSTR = 'abc&'",
+    "CONTINUE  'def&'",
+    "CONTINUE  'ghi'                / end of the long string",
+    "HIERARCH ESO DET GAIN = 1.5 / hierarch",
+    "HIERARCH ESO DET NAME = 'chip' / hierarch",
+    "        blank keyword text",
+    "COMMENT a comment",
+    "HISTORY some history",
+    "UNDEF   =                      / undefined value",
+    "CPLX    = (1.0, 2.0)",
+    "CPLXINT = (1, -2)",
+    "DEXP    =              1.5D+03",
+    "INT     =                  +42",
+    "FLOAT   =                  1E5",
+    "LOGICAL =                    F",
+    "END",
+]
+
+
+def _header_bytes(cards):
+    buf = b''.join(c.ljust(CARD_SIZE).encode('ascii') for c in cards)
+    return buf + b' ' * (-len(buf) % BLOCK_SIZE)
+
+
+@pytest.fixture
+def crafted(tmp_path):
+    path = tmp_path / 'crafted.fits'
+    path.write_bytes(_header_bytes(CARDS))
+    return path
+
+
+def _python_scan_cards():
+    # The uncompiled scanner, whether or not Numba is installed
+    return getattr(_fastheader._scan_cards, 'py_func', _fastheader._scan_cards)
+
+
+@pytest.fixture(params = ['cards', 'scanned', 'scanned-python'])
+def parse(request, monkeypatch):
+    if request.param == 'cards':
+        return _fastheader._parse_cards
+    if request.param == 'scanned-python':
+        monkeypatch.setattr(_fastheader, '_scan_cards', _python_scan_cards())
+    return _fastheader._parse_scanned
+
+
+def _astropy_header(path):
+    # Commentary cards carry no value and are skipped by the fast reader
+    return {k: str(v) for k, v in fits.getheader(path).items() if k not in ('COMMENT', 'HISTORY', '')}
+
+
+def test_parse_matches_astropy(crafted, parse):
+    assert parse(crafted.read_bytes()) == _astropy_header(crafted)
+
+
+def test_scanners_agree(crafted):
+    buf = np.frombuffer(crafted.read_bytes(), dtype = np.uint8)
+    compiled = _fastheader._scan_cards(buf)
+    python = _python_scan_cards()(buf)
+    assert compiled[0] == python[0] == len(CARDS) - 1
+    for a, b in zip(compiled[1:], python[1:]):
+        np.testing.assert_array_equal(a, b)
+
+
+def test_fast_header_matches_astropy(crafted):
+    assert fast_header(crafted) == _astropy_header(crafted)
+
+
+def test_missing_end_card_raises(parse):
+    buf = _header_bytes(CARDS[:-1])
+    with pytest.raises(ValueError):
+        parse(buf)
+
+
+def test_non_fits_raises_oserror():
+    with pytest.raises(OSError):
+        header_from_bytes(b'not a fits file'.ljust(BLOCK_SIZE))
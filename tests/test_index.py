@@ -0,0 +1,69 @@
+import os
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from ori import index as ori_index
+from ori.app import _manifest, parse_fits_headers
+from ori.cache import Cache
+from ori.index import Index
+
+
+def _write_fits(path, **cards):
+    header = fits.Header()
+    for key, value in cards.items():
+        header[key] = value
+    fits.PrimaryHDU(data = np.zeros((2, 2), dtype = np.uint16), header = header).writeto(path)
+
+
+@pytest.fixture
+def index(tmp_path, monkeypatch):
+    # Use the default configuration rather than whatever is in the user's config directory
+    monkeypatch.setenv('XDG_CONFIG_HOME', str(tmp_path / 'config'))
+    root = tmp_path / 'data'
+    root.mkdir()
+    files = []
+    for i in range(3):
+        f = str(root / f'img_{i}.fits')
+        _write_fits(
+            f, INSTRUME = 'ZWO ASI294MM', IMAGETYP = 'Light Frame', OBJECT = 'M 31', FILTER = 'L',
+            EXPTIME = 300.0, GAIN = 120, OFFSET = 30, XBINNING = 1, YBINNING = 1,
+            **{'CCD-TEMP': -10.0, 'DATE-OBS': f'2022-01-10T00:12:3{i}.123'}, SESSION = '2022-01-09'
+        )
+        files.append(f)
+    cache = Cache(root)
+    parse_fits_headers(files, cache, max_workers = 1, manifest = list(_manifest(files)))
+    headers, _ = cache.get_for(files)
+    return Index(headers, root)
+
+
+def test_sync_keeps_failed_header_writes_changed(index, tmp_path, monkeypatch):
+    index._change_attr('OBJECT', 'M 33')
+    index.change_subtree(tmp_path / 'moved')
+    assert index.n_changed() == 3
+
+    failing = os.path.join(str(tmp_path / 'moved'), 'img_1.fits')
+    fits_open = fits.open
+    def _open(name, *args, **kwargs):
+        if kwargs.get('mode') == 'update' and str(name) == failing:
+            raise OSError('disk full')
+        return fits_open(name, *args, **kwargs)
+    monkeypatch.setattr(ori_index.fits, 'open', _open)
+
+    version = index._version
+    index.sync('move')
+
+    # Every file was moved, but only the failed one still has unsaved changes, under its new key
+    assert sorted(map(str, index.df.index)) == sorted(
+        os.path.join(str(tmp_path / 'moved'), f'img_{i}.fits') for i in range(3)
+    )
+    assert [str(f) for f in index._changed] == [failing]
+    assert all(f in index.df.index for f in index._changed)
+    assert index.n_changed() == 1
+    assert index._version > version
+
+    monkeypatch.setattr(ori_index.fits, 'open', fits_open)
+    objects = {str(f): fits.getheader(f)['OBJECT'] for f in index.df.index}
+    assert objects.pop(failing) == 'M 31'
+    assert set(objects.values()) == {'M 33'}
@@ -0,0 +1,48 @@
+import sqlite3
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from astropy.io import fits
+
+from ori.index2 import SqlIndex
+from ori.utils import parse_files
+
+
+def _write_fits(path, date_obs, **cards):
+    header = fits.Header()
+    header['DATE-OBS'] = date_obs
+    for key, value in cards.items():
+        header[key] = value
+    fits.PrimaryHDU(data=np.zeros((2, 2), dtype=np.uint16), header=header).writeto(path)
+
+
+def test_df_to_sql_round_trips_parsed_headers(tmp_path):
+    _write_fits(tmp_path / 'a.fits', '2022-01-10T00:12:30.123', OBJECT='M 31', EXPTIME=300.0, GAIN=120)
+    _write_fits(tmp_path / 'b.fits', '2022-01-11T01:00:00', OBJECT='M 33', EXPTIME=60.0, GAIN=120)
+    rows, skipped = parse_files([str(tmp_path / 'a.fits'), str(tmp_path / 'b.fits')], max_workers=1)
+    assert skipped == []
+
+    db = tmp_path / 'index.db'
+    con = sqlite3.connect(db)
+    con.execute('pragma journal_mode = wal')
+    con.close()
+
+    SqlIndex(tmp_path, header_df=pd.DataFrame(rows))
+
+    con = sqlite3.connect(db)
+    try:
+        stored = pd.read_sql('select * from header order by name', con)
+        journal_mode, = con.execute('pragma journal_mode').fetchone()
+    finally:
+        con.close()
+
+    assert stored.name.tolist() == ['a.fits', 'b.fits']
+    assert stored.object.tolist() == ['M 31', 'M 33']
+    assert stored.exptime.tolist() == [300.0, 60.0]
+    assert [datetime.fromisoformat(d) for d in stored.date_obs] == [
+        datetime(2022, 1, 10, 0, 12, 30, 123000),
+        datetime(2022, 1, 11, 1, 0, 0),
+    ]
+    # The bulk-load pragmas are put back the way they were
+    assert journal_mode == 'wal'